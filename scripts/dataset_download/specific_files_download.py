@@ -1,91 +1,1381 @@
-import pandas as pd
 import asyncio
+import errno
+import hashlib
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import shutil
 import sys
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from itertools import zip_longest
+from urllib.parse import urljoin, urlparse
 import subprocess
 import argparse
-from typing import List, Set
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
-def download_patient_data(patient_id: str, wget_path: Path, download_directory: Path, username: str, password: str) -> None:
+import aiofiles
+import aiohttp
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from selectolax.lexbor import LexborHTMLParser
+from tenacity import AsyncRetrying, RetryCallState, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+URL_BASE = "https://physionet.org/files/mimic-cxr-jpg/2.0.0/files/"  # Root of the MIMIC-CXR-JPG patient folders
+CHECKSUMS_URL = urljoin(URL_BASE, "../SHA256SUMS.txt")  # PhysioNet's SHA-256 list of every file in the dataset
+MANIFEST_NAME = "manifest.parquet"  # Per-patient verification results, kept in the download directory
+MANIFEST_INTERVAL = 60  # Seconds between saves of the manifest while downloading
+CHUNK_SIZE = 1 << 20  # Bytes read from the socket per write
+RANGE_THRESHOLD = 4 << 20  # Files larger than this are fetched as parallel byte ranges
+RANGE_WORKERS = 4  # Concurrent range requests per file
+DEFAULT_BANDWIDTH = 100.0  # Mbit/s assumed when sizing the worker pool without --bandwidth
+WORKER_WINDOW = 64 << 10  # Bytes a single connection is assumed to keep in flight
+SIZING_CONCURRENCY = 32  # Requests in flight per batch while listing or measuring patient folders ahead of the downloads
+RETRY_ATTEMPTS = 5  # Attempts per patient (or downloader batch) before giving up
+DOWNLOADERS = ["wget2", "aria2c", "wget"]  # Preference order of the wget backend when --wget_path is not given
+# Exit statuses worth retrying: wget/wget2 generic, network, protocol and server errors (5xx/429 included);
+# aria2c unknown, timeout, too slow, network, unfinished, name resolution, bad HTTP header and 503 errors
+TRANSIENT_EXIT_CODES = {"wget": {1, 4, 7, 8}, "aria2c": {1, 2, 5, 6, 7, 19, 22, 29}}
+
+log = logging.getLogger("specific_files_download")
+
+
+def start_logging() -> logging.handlers.QueueListener:
+    """
+    Routes the download log through a queue drained by a single background thread.
+
+    Workers only enqueue records, so they never contend for the terminal; the listener
+    thread does all the writing.
+
+    Returns:
+        The started listener, to be stopped on shutdown.
     """
-    Downloads data for a given patient from PhysioNet.
+
+    records = queue.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+
+    log.addHandler(logging.handlers.QueueHandler(records))
+    log.setLevel(logging.INFO)
+    return listener
+
+
+def iter_patient_ids(mimic_iv_csv_path: Path) -> Iterator[List[int]]:
+    """
+    Reads the subject IDs from a MIMIC-IV CSV file one block at a time.
+
+    Only the subject_id column is parsed, so memory stays bounded regardless of the
+    size of the CSV. Each block is deduplicated in Arrow before any Python objects
+    are created; an ID can still appear again in a later block.
 
     Args:
-        patient_id: The ID of the patient to download data for.
-        wget_path: The path to the wget executable.
+        mimic_iv_csv_path: The path to the CSV file containing the patient IDs.
+
+    Yields:
+        The unique valid (positive) subject IDs of each block.
+    """
+
+    convert_options = pacsv.ConvertOptions(include_columns=["subject_id"], column_types={"subject_id": pa.int64()})
+    with pacsv.open_csv(mimic_iv_csv_path, convert_options=convert_options) as reader:
+        for batch in reader:
+            unique = pc.unique(batch.column(0))
+            yield unique.filter(pc.greater(unique, 0)).to_pylist()  # Also drops missing IDs
+
+
+def read_patient_ids(mimic_iv_csv_path: Path) -> Set[int]:
+    """
+    Reads the unique subject IDs from a MIMIC-IV CSV file.
+
+    Args:
+        mimic_iv_csv_path: The path to the CSV file containing the patient IDs.
+
+    Returns:
+        The set of valid (positive) subject IDs.
+    """
+
+    patient_ids = set()
+    for block in iter_patient_ids(mimic_iv_csv_path):
+        patient_ids.update(block)
+    return patient_ids
+
+
+def interleave_shards(patient_ids: Set[int]) -> List[int]:
+    """
+    Orders the patients so that consecutive downloads hit different pNN shard folders.
+
+    The patients are shuffled (with a fixed seed, so re-runs use the same order) and then
+    dealt round-robin across the shards, which keeps concurrent workers spread over all
+    of them instead of hammering one prefix at a time.
+
+    Args:
+        patient_ids: The IDs of the patients to download data for.
+
+    Returns:
+        The patient IDs in download order.
+    """
+
+    ordered = sorted(patient_ids)
+    random.Random(0).shuffle(ordered)
+
+    shards = defaultdict(list)
+    for patient_id in ordered:
+        shards[f"{patient_id:08d}"[:2]].append(patient_id)
+    return [patient_id for group in zip_longest(*shards.values()) for patient_id in group if patient_id is not None]
+
+
+class ChecksumMismatch(Exception):
+    """Raised when downloaded files do not match PhysioNet's SHA256SUMS.txt."""
+
+
+class EmptyListing(Exception):
+    """Raised when an existing patient folder lists no files, e.g. a page that is not a PhysioNet listing."""
+
+
+class MissingChecksums(Exception):
+    """Raised when none of the files of a patient are listed in SHA256SUMS.txt, so none of them can be verified."""
+
+
+def is_missing(error: BaseException) -> bool:
+    """
+    Tells whether a request failed because the remote folder does not exist, i.e. the patient has no images.
+
+    Args:
+        error: The error raised by the request.
+
+    Returns:
+        Whether the error is a 404 response.
+    """
+
+    return isinstance(error, aiohttp.ClientResponseError) and error.status == 404
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Tells whether a failed download is worth retrying.
+
+    Connection resets, timeouts, DNS failures, 5xx/429 responses, empty folder listings,
+    files that fail verification and the TRANSIENT_EXIT_CODES of the external downloaders are; other
+    HTTP errors and exit statuses, e.g. authentication failures, are not.
+
+    Args:
+        error: The error raised by the download.
+
+    Returns:
+        Whether the download should be retried.
+    """
+
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    if isinstance(error, subprocess.CalledProcessError):
+        downloader = "aria2c" if Path(error.cmd[0]).name.startswith("aria2c") else "wget"
+        return error.returncode in TRANSIENT_EXIT_CODES[downloader]
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, ChecksumMismatch, EmptyListing))
+
+
+def log_retry(state: RetryCallState) -> None:
+    """
+    Reports a failed attempt that is about to be retried.
+
+    Args:
+        state: The state of the retried call.
+    """
+
+    log.warning("Attempt %d failed, retrying in %.1f s: %s", state.attempt_number, state.next_action.sleep, state.outcome.exception())
+
+
+def retrying() -> AsyncRetrying:
+    """
+    Builds the retry policy of a download: up to RETRY_ATTEMPTS attempts, with jittered
+    exponential backoff between 1 and 60 seconds, for transient errors only.
+
+    Returns:
+        The policy, to be iterated with "async for attempt in retrying()".
+    """
+
+    return AsyncRetrying(
+        stop=stop_after_attempt(RETRY_ATTEMPTS),
+        wait=wait_exponential_jitter(1, 60),
+        retry=retry_if_exception(is_transient),
+        before_sleep=log_retry,
+        reraise=True,
+    )
+
+
+def rebase(url: str, old_base: str, new_base: str) -> str:
+    """
+    Moves a URL from one mirror of the MIMIC-CXR-JPG tree to another.
+
+    Args:
+        url: A URL below old_base.
+        old_base: The base URL of the mirror the URL currently points to.
+        new_base: The base URL of the target mirror.
+
+    Returns:
+        The URL of the same file below new_base.
+    """
+
+    return new_base + url[len(old_base):]
+
+
+def local_path(url: str, download_directory: Path) -> Path:
+    """
+    Maps a PhysioNet URL to the same location wget -r would have written it to.
+
+    Args:
+        url: The URL of the remote file.
+        download_directory: The directory where the downloaded data should be saved.
+
+    Returns:
+        The local path of the file.
+    """
+
+    parsed = urlparse(url)
+    return download_directory / parsed.netloc / parsed.path.lstrip("/")
+
+
+def find_downloader(wget_path: Optional[Path]) -> Path:
+    """
+    Picks the executable used by the wget backend.
+
+    wget2 is preferred because it multiplexes requests over HTTP/2, then aria2c, which
+    splits files into parallel range requests, and finally plain wget.
+
+    Args:
+        wget_path: An explicitly requested executable, if any.
+
+    Returns:
+        The path to the downloader.
+    """
+
+    if wget_path is not None:
+        return wget_path
+    for name in DOWNLOADERS:
+        found = shutil.which(name)
+        if found:
+            return Path(found)
+    raise FileNotFoundError(f"None of {', '.join(DOWNLOADERS)} was found on the PATH")
+
+
+def downloader_command(executable: Path, download_directory: Path, username: str, password: str) -> List[str]:
+    """
+    Builds the command of an external downloader that reads its URLs from standard input.
+
+    The downloader is fed the file URLs listed by list_tree, so it never recurses itself;
+    wget and wget2 still mirror the host and path layout of each URL with -x. aria2c may
+    also be fed mirror URLs, so it gets the credentials per PhysioNet URL in its input instead.
+
+    Args:
+        executable: The path to wget, wget2 or aria2c.
         download_directory: The directory where the downloaded data should be saved.
+        username: The PhysioNet username, for wget and wget2.
+        password: The PhysioNet password, for wget and wget2.
+
+    Returns:
+        The command line.
+    """
+
+    if executable.name.startswith("aria2c"):
+        return [
+            str(executable.resolve()),
+            "-x16", "-s16", "-j16", "-c", "--auto-file-renaming=false",
+            "-d", str(download_directory.resolve()),
+            "-i", "-",
+        ]
+
+    command = [str(executable.resolve())]
+    if executable.name.startswith("wget2"):
+        command += ["--http2-request-window=30", "--max-threads=8"]
+    return command + [
+        "-i", "-",
+        "-x", "-N", "-c", "-P",
+        str(download_directory.resolve()),
+        "--user", username,
+        "--password", password,
+    ]
+
+
+def open_session(limit: int) -> aiohttp.ClientSession:
+    """
+    Opens the HTTP session shared by all patients, so TCP connections and TLS sessions are reused.
+
+    The session carries no credentials; see request_auth.
+
+    Args:
+        limit: The maximum number of open connections.
+
+    Returns:
+        The session.
+    """
+
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit, ttl_dns_cache=600)
+    return aiohttp.ClientSession(connector=connector)
+
+
+def request_auth(url: str, auth: Optional[aiohttp.BasicAuth]) -> Optional[aiohttp.BasicAuth]:
+    """
+    Picks the credentials to send with a request: PhysioNet gets them, --mirror hosts never do.
+
+    Args:
+        url: The URL of the request.
+        auth: The PhysioNet credentials.
+
+    Returns:
+        The credentials if the URL is on PhysioNet, else None.
+    """
+
+    return auth if urlparse(url).netloc == urlparse(URL_BASE).netloc else None
+
+
+async def measure_rtt(username: str, password: str) -> float:
+    """
+    Measures the round-trip time to PhysioNet with HEAD requests.
+
+    The first request pays for DNS, TCP and TLS setup, so the fastest of a few
+    requests over the same connection is used.
+
+    Args:
         username: The PhysioNet username.
         password: The PhysioNet password.
+
+    Returns:
+        The round-trip time in seconds.
     """
-    
+
+    loop = asyncio.get_running_loop()
+    samples = []
+    async with open_session(1) as session:
+        for _ in range(3):
+            start = loop.time()
+            async with session.head(URL_BASE, auth=aiohttp.BasicAuth(username, password)) as response:
+                await response.read()
+            samples.append(loop.time() - start)
+    return min(samples)
+
+
+def worker_count(bandwidth: float, rtt: float) -> int:
+    """
+    Sizes the download pool from the bandwidth-delay product of the link.
+
+    A single connection moves about WORKER_WINDOW bytes per round trip, so saturating
+    the link takes bandwidth * rtt / WORKER_WINDOW connections. The result is clamped
+    to [8, 128] and to four workers per usable CPU, which parse listings and write files.
+
+    Args:
+        bandwidth: The available bandwidth in Mbit/s.
+        rtt: The round-trip time to PhysioNet in seconds.
+
+    Returns:
+        The number of workers.
+    """
+
     try:
-        folder = f"p{patient_id[:2]}"  # Derive the folder from the first two digits
-        patient_folder = f"p{patient_id}"  # Derive the patient-specific folder
-
-        # Construct the URL
-        url = f"https://physionet.org/files/mimic-cxr-jpg/2.0.0/files/{folder}/{patient_folder}/"
-        print(f"Downloading data for patient {patient_id} from {url}")
-
-        # Construct the wget command
-        command = [
-            str(wget_path.resolve()),
-            "-r", "-N", "-c", "-np", "-P",
-            str(download_directory.resolve()),
-            "--user", username,
-            "--password", password,
-            url
-        ]
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS or Windows
+        cpus = os.cpu_count() or 1
+
+    bandwidth_delay_product = bandwidth * 1e6 / 8 * rtt
+    return min(max(8, min(128, int(bandwidth_delay_product / WORKER_WINDOW))), cpus * 4)
+
+
+def patient_url(patient_id: int, base: str = URL_BASE) -> str:
+    """
+    Builds the URL of a patient's MIMIC-CXR-JPG folder on PhysioNet or one of its mirrors.
+
+    Args:
+        patient_id: The ID of the patient.
+        base: The base URL of the mirror.
+
+    Returns:
+        The URL of the folder, ending with a slash.
+    """
+
+    folder = f"p{patient_id:08d}"[:3]  # Derive the folder from the first two digits
+    patient_folder = f"p{patient_id}"  # Derive the patient-specific folder
+    return f"{base}{folder}/{patient_folder}/"
+
+
+def completion_marker(patient_id: int, download_directory: Path) -> Path:
+    """
+    Locates the sentinel file written once a patient's folder has been fully downloaded.
+
+    Args:
+        patient_id: The ID of the patient.
+        download_directory: The directory where the downloaded data should be saved.
+
+    Returns:
+        The path of the sentinel, inside the local copy of the patient folder.
+    """
+
+    return local_path(patient_url(patient_id), download_directory) / ".complete"
+
+
+def pending_patients(patient_ids: Set[int], download_directory: Path, verified: Optional[Set[int]] = None) -> Set[int]:
+    """
+    Drops the patients finished by a previous run, without touching the network.
+
+    Args:
+        patient_ids: The IDs of the patients to download data for.
+        download_directory: The directory where the downloaded data should be saved.
+        verified: The patients verified against SHA256SUMS.txt by a previous run. When given,
+            only these are skipped, so folders completed without verification are checked.
+
+    Returns:
+        The IDs of the patients that still need downloading.
+    """
+
+    if verified is not None:
+        return patient_ids - verified
+    return {patient_id for patient_id in patient_ids if not completion_marker(patient_id, download_directory).exists()}
+
+
+def mark_complete(patient_id: int, download_directory: Path) -> None:
+    """
+    Records that a patient's folder has been fully downloaded, so re-runs skip it.
+
+    Args:
+        patient_id: The ID of the patient.
+        download_directory: The directory where the downloaded data should be saved.
+    """
+
+    marker = completion_marker(patient_id, download_directory)
+    marker.parent.mkdir(parents=True, exist_ok=True)
+    marker.touch()
+
+
+def read_checksums(path: Path) -> Dict[str, str]:
+    """
+    Parses a sha256sum-style list of the dataset files.
+
+    Args:
+        path: The local copy of SHA256SUMS.txt.
+
+    Returns:
+        The expected SHA-256 hex digest of every file, keyed by its URL.
+    """
+
+    checksums = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                digest, name = line.split(maxsplit=1)
+                checksums[urljoin(CHECKSUMS_URL, name.strip().lstrip("*"))] = digest.lower()
+    return checksums
+
+
+async def fetch_checksums(session: aiohttp.ClientSession, download_directory: Path, auth: Optional[aiohttp.BasicAuth] = None) -> Dict[str, str]:
+    """
+    Downloads SHA256SUMS.txt once, next to the patient folders, and indexes it.
+
+    Args:
+        session: The shared HTTP session.
+        download_directory: The directory where the downloaded data should be saved.
+        auth: The PhysioNet credentials.
+
+    Returns:
+        The expected digest of every file keyed by its URL, empty if the list could not be
+        downloaded, in which case nothing is verified.
+    """
+
+    destination = local_path(CHECKSUMS_URL, download_directory)
+    try:
+        async for attempt in retrying():
+            with attempt:
+                await download_file(session, CHECKSUMS_URL, destination, auth=auth)
+        return await asyncio.get_running_loop().run_in_executor(None, read_checksums, destination)
+    except Exception as e:
+        log.warning("Could not download %s, downloads will not be verified: %s", CHECKSUMS_URL, e)
+        return {}
+
+
+def sha256(path: Path) -> str:
+    """
+    Hashes a file, with OpenSSL's hashlib.file_digest where available (Python 3.11+).
+
+    Args:
+        path: The file to hash.
+
+    Returns:
+        The SHA-256 hex digest of the file.
+    """
+
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+def verify_files(file_urls: List[str], download_directory: Path, checksums: Dict[str, str]) -> None:
+    """
+    Checks downloaded files against SHA256SUMS.txt and deletes the ones that do not match,
+    so the next attempt fetches them again instead of resuming them.
+
+    Args:
+        file_urls: The URLs below URL_BASE of the files to check.
+        download_directory: The directory where the downloaded data should be saved.
+        checksums: The expected digests from fetch_checksums. Files not listed there are not checked.
+
+    Raises:
+        MissingChecksums: If there are no files or none of them are listed in checksums.
+        ChecksumMismatch: If any file is missing or does not match.
+    """
+
+    unlisted = [file_url for file_url in file_urls if file_url not in checksums]
+    if len(unlisted) == len(file_urls):
+        raise MissingChecksums(f"none of {len(file_urls)} files are listed in {CHECKSUMS_URL}")
+    if unlisted:
+        log.warning("%d files are not listed in %s and were not verified, e.g. %s", len(unlisted), CHECKSUMS_URL, unlisted[0])
+
+    corrupt = []
+    for file_url in file_urls:
+        expected = checksums.get(file_url)
+        path = local_path(file_url, download_directory)
+        if expected is None or (path.exists() and sha256(path) == expected):
+            continue
+        corrupt.append(file_url)
+        if path.exists():
+            path.unlink()
+
+    if corrupt:
+        raise ChecksumMismatch(f"{len(corrupt)} files do not match {CHECKSUMS_URL}, e.g. {corrupt[0]}")
+
+
+def read_verified(download_directory: Path) -> Set[int]:
+    """
+    Loads the patients a previous run verified, or found to have no images, from the manifest.
+
+    Args:
+        download_directory: The directory where the downloaded data should be saved.
+
+    Returns:
+        The IDs of the patients to skip, empty if there is no manifest yet.
+    """
+
+    path = download_directory / MANIFEST_NAME
+    if not path.exists():
+        return set()
+    table = pq.read_table(path)
+    return {patient_id for patient_id, verified in zip(table["subject_id"].to_pylist(), table["verified"].to_pylist()) if verified is not False}
+
+
+def write_manifest(results: Dict[int, Optional[bool]], download_directory: Path) -> None:
+    """
+    Merges the outcome of this run into the manifest; the latest result of a patient wins.
+    Patients without images are stored as null, so they are skipped without counting as verified.
+
+    Args:
+        results: Whether each patient handled by this run was downloaded and verified, None if it has no images.
+        download_directory: The directory where the downloaded data should be saved.
+    """
+
+    path = download_directory / MANIFEST_NAME
+    merged = {}
+    if path.exists():
+        previous = pq.read_table(path)
+        merged.update(zip(previous["subject_id"].to_pylist(), previous["verified"].to_pylist()))
+    merged.update(results)
+
+    table = pa.table({
+        "subject_id": pa.array(list(merged), pa.int64()),
+        "verified": pa.array(list(merged.values()), pa.bool_()),
+    })
+    download_directory.mkdir(parents=True, exist_ok=True)
+    partial = partial_path(path)
+    pq.write_table(table, partial)
+    os.replace(partial, path)
+
+
+async def save_manifest(results: Dict[int, Optional[bool]], download_directory: Path) -> None:
+    """
+    Saves the manifest every MANIFEST_INTERVAL seconds until cancelled, so a run that
+    crashes loses at most that much verification work.
+
+    The manifest is small, so it is written on the event loop: a write running on an
+    executor thread could still be going when the final save of the run starts.
+
+    Args:
+        results: Collects whether each patient was downloaded and verified, filled by the workers.
+        download_directory: The directory where the downloaded data should be saved.
+    """
+
+    while True:
+        await asyncio.sleep(MANIFEST_INTERVAL)
+        write_manifest(results, download_directory)
+
+
+async def list_tree(session: aiohttp.ClientSession, url: str, auth: Optional[aiohttp.BasicAuth] = None) -> List[str]:
+    """
+    Recursively enumerates the files below a PhysioNet directory listing.
+
+    Only the listings are fetched here, sibling subdirectories concurrently, so the
+    downloads that follow are all leaf GETs.
+
+    Args:
+        session: The shared HTTP session.
+        url: The URL of the directory, ending with a slash.
+        auth: The PhysioNet credentials, only sent to PhysioNet.
+
+    Returns:
+        The URLs of all files below the directory.
+    """
+
+    async with session.get(url, auth=request_auth(url, auth)) as response:
+        response.raise_for_status()
+        html = await response.text()
+
+    files, subdirectories = [], []
+    for anchor in LexborHTMLParser(html).css("a[href]"):
+        href = anchor.attributes["href"] or ""
+        child = urljoin(url, href)
+        # Only descend: skip the parent directory, column sorting links and anything off-tree
+        if "?" in href or "#" in href or child == url or not child.startswith(url):
+            continue
+        (subdirectories if child.endswith("/") else files).append(child)
+
+    for nested in await asyncio.gather(*(list_tree(session, subdirectory, auth) for subdirectory in subdirectories)):
+        files.extend(nested)
+    return files
+
+
+async def list_patient_files(session: aiohttp.ClientSession, patient_id: int, auth: Optional[aiohttp.BasicAuth] = None) -> List[str]:
+    """
+    Lists the files of a patient folder on PhysioNet.
+
+    Mirrors are only used for the file downloads: they need not serve HTML listings,
+    so their answer for a folder says nothing about whether the patient has images.
+
+    Args:
+        session: The shared HTTP session.
+        patient_id: The ID of the patient.
+        auth: The PhysioNet credentials.
+
+    Returns:
+        The URLs of the patient's files below URL_BASE.
+
+    Raises:
+        aiohttp.ClientResponseError: A 404 if the patient has no images (see is_missing).
+        EmptyListing: If the folder exists but no file could be found in its listing.
+    """
+
+    file_urls = await list_tree(session, patient_url(patient_id), auth)
+    if not file_urls:
+        raise EmptyListing(f"No files found in {patient_url(patient_id)}")
+    return file_urls
+
+
+def partial_path(destination: Path) -> Path:
+    """
+    Locates the temporary file a download is written to before it is renamed into place.
+
+    Args:
+        destination: The local path of the file.
+
+    Returns:
+        The path of the ".part" file next to the destination.
+    """
+
+    return destination.with_name(destination.name + ".part")
+
+
+def ranges_path(destination: Path) -> Path:
+    """
+    Locates the file recording which byte ranges of a ".part" file download_ranges has finished.
+
+    Args:
+        destination: The local path of the file.
+
+    Returns:
+        The path of the ".ranges" file next to the destination.
+    """
+
+    return destination.with_name(destination.name + ".part.ranges")
+
+
+def finished_ranges(destination: Path, total: int) -> Set[int]:
+    """
+    Reads the byte ranges an interrupted download_ranges already wrote.
+
+    Args:
+        destination: The local path of the file.
+        total: The size of the file in bytes.
+
+    Returns:
+        The start offsets of the finished ranges, empty if the ".part" file cannot be resumed.
+    """
+
+    partial, progress = partial_path(destination), ranges_path(destination)
+    if not partial.exists() or not progress.exists() or partial.stat().st_size != total:
+        return set()
+    lines = progress.read_text().split()
+    if not lines or int(lines[0]) != total:  # The remote file changed size meanwhile
+        return set()
+    return {int(lo) for lo in lines[1:]}
+
+
+def discard_partial(destination: Path) -> None:
+    """
+    Deletes the leftovers of an earlier download of a file that cannot be resumed.
+
+    Args:
+        destination: The local path of the file.
+    """
+
+    for leftover in (partial_path(destination), ranges_path(destination)):
+        if leftover.exists():
+            leftover.unlink()
+
+
+def preallocate(fd: int, size: int) -> None:
+    """
+    Reserves the space of a file before writing it, so it gets contiguous extents and
+    the filesystem updates its metadata once instead of on every write.
+
+    Args:
+        fd: The descriptor of the file.
+        size: The final size of the file in bytes.
+    """
+
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except AttributeError:  # No posix_fallocate on macOS
+        os.ftruncate(fd, size)
+    except OSError as e:
+        # Only fall back when the filesystem cannot preallocate; a full disk must still fail
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+        os.ftruncate(fd, size)
+
+
+def write_file(destination: Path, data: bytes, append: bool) -> None:
+    """
+    Writes a downloaded file in one call, so it can run as a single executor job.
+
+    The data goes to the ".part" file, which is renamed into place once written. A new
+    ".part" file is preallocated to its full size, which download_file never resumes.
+
+    Args:
+        destination: The local path of the file.
+        data: The content to write.
+        append: Whether data continues the ".part" file of an interrupted download.
+    """
+
+    partial = partial_path(destination)
+    with open(partial, "ab" if append else "wb") as f:
+        if not append:
+            preallocate(f.fileno(), len(data))
+        f.write(data)
+    os.replace(partial, destination)
+
+
+async def download_ranges(session: aiohttp.ClientSession, url: str, destination: Path, total: int, auth: Optional[aiohttp.BasicAuth] = None) -> bool:
+    """
+    Downloads a single file as RANGE_WORKERS concurrent byte ranges.
+
+    The shards are written in place with positional writes into a preallocated
+    ".part" file, which is only renamed to the destination once every range has arrived.
+    Finished shards are recorded in a ".ranges" file next to it, so a retry only
+    fetches the missing ones.
+
+    Args:
+        session: The shared HTTP session.
+        url: The URL of the file.
+        destination: The local path of the file.
+        total: The size of the file in bytes.
+        auth: The PhysioNet credentials, only sent to PhysioNet.
+
+    Returns:
+        Whether the file was downloaded, False if the server ignored the Range header.
+    """
+
+    loop = asyncio.get_running_loop()
+    partial, progress = partial_path(destination), ranges_path(destination)
+    step = -(-total // RANGE_WORKERS)
+    bounds = [(lo, min(lo + step, total) - 1) for lo in range(0, total, step)]
+
+    done = finished_ranges(destination, total)
+    if not done:
+        discard_partial(destination)
+
+    async def fetch_range(lo: int, hi: int) -> bool:
+        async with session.get(url, headers={"Range": f"bytes={lo}-{hi}"}, auth=request_auth(url, auth)) as response:
+            response.raise_for_status()
+            if response.status != 206:
+                return False
+            position = lo
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                await loop.run_in_executor(None, os.pwrite, fd, chunk, position)
+                position += len(chunk)
+        with open(progress, "a") as f:
+            f.write(f"{lo}\n")
+        return True
+
+    fd = os.open(partial, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if not done:
+            preallocate(fd, total)
+            progress.write_text(f"{total}\n")
+        # Let every range finish before the descriptor is closed, even if one of them failed
+        results = await asyncio.gather(*(fetch_range(lo, hi) for lo, hi in bounds if lo not in done), return_exceptions=True)
+    finally:
+        os.close(fd)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    if not all(results):
+        discard_partial(destination)
+        return False
+    os.replace(partial, destination)
+    progress.unlink()
+    return True
+
+
+async def head_file(session: aiohttp.ClientSession, url: str, auth: Optional[aiohttp.BasicAuth] = None) -> Tuple[Optional[int], bool]:
+    """
+    Asks the server for the size of a file and whether it serves byte ranges of it.
+
+    Args:
+        session: The shared HTTP session.
+        url: The URL of the file.
+        auth: The PhysioNet credentials, only sent to PhysioNet.
+
+    Returns:
+        The size of the file in bytes, if known, and whether it accepts byte ranges.
+    """
+
+    async with session.head(url, allow_redirects=True, auth=request_auth(url, auth)) as response:
+        response.raise_for_status()
+        return response.content_length, response.headers.get("Accept-Ranges") == "bytes"
+
 
-        # Run the wget command
-        subprocess.run(command, check=True)
+async def download_file(session: aiohttp.ClientSession, url: str, destination: Path, head: Optional[Tuple[Optional[int], bool]] = None, auth: Optional[aiohttp.BasicAuth] = None) -> None:
+    """
+    Downloads a single file, resuming a partial download like wget -c.
+
+    Downloads go to a ".part" file that is renamed into place once complete. An interrupted
+    download is resumed from the end of its ".part" file, unless that file already has the
+    full size, i.e. was preallocated and says nothing about how much of it was written.
+    Large files on servers that accept byte ranges are split across parallel
+    requests; everything else is streamed over a single GET.
+
+    Args:
+        session: The shared HTTP session.
+        url: The URL of the file.
+        destination: The local path of the file.
+        head: The result of head_file for the file when already known, e.g. from --prefetch_sizes.
+        auth: The PhysioNet credentials, only sent to PhysioNet.
+    """
+
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    total, accepts_ranges = head if head is not None else await head_file(session, url, auth)
+
+    partial = partial_path(destination)
+    if destination.exists():
+        size = destination.stat().st_size
+        if total is not None and size == total:
+            discard_partial(destination)
+            return
+        if total is not None and size < total and not partial.exists():
+            # Resume a partial file left by wget -c
+            os.replace(destination, partial)
+
+    if accepts_ranges and total is not None and total > RANGE_THRESHOLD:
+        if await download_ranges(session, url, destination, total, auth):
+            return
+        log.info("%s ignored the Range header, downloading it with a single request", url)
+
+    # A ".part" file with a ".ranges" file was preallocated by download_ranges and cannot be resumed here
+    offset = partial.stat().st_size if partial.exists() and not ranges_path(destination).exists() else 0
+    if total is None or offset >= total:  # Nothing to resume from, start over
+        offset = 0
+        discard_partial(destination)
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    async with session.get(url, headers=headers, auth=request_auth(url, auth)) as response:
+        # The remote file changed since the ".part" file was started; start over once this
+        # response has given its connection back to the pool
+        changed = response.status == 416
+        if not changed:
+            response.raise_for_status()
+
+            # Servers that ignore the Range header send the whole file again
+            append = response.status == 206
+
+            # Most files are a single CXR image or report: buffer them and hand the open, write
+            # and close to the executor in one go instead of one thread hop per operation
+            if response.content_length is not None and response.content_length <= RANGE_THRESHOLD:
+                body = await response.read()
+                await asyncio.get_running_loop().run_in_executor(None, write_file, destination, body, append)
+                return
+
+            # Streamed downloads are not preallocated, so the ".part" file only ever holds what
+            # was written and an interruption can be resumed from its end
+            async with aiofiles.open(partial, "ab" if append else "wb") as f:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    await f.write(chunk)
+
+    if changed:
+        discard_partial(destination)
+        return await download_file(session, url, destination, auth=auth)
+    os.replace(partial, destination)
+
+
+async def fetch_patient(session: aiohttp.ClientSession, patient_id: int, download_directory: Path, semaphore: asyncio.Semaphore, file_urls: Optional[List[str]] = None, mirrors: Optional[List[str]] = None, checksums: Optional[Dict[str, str]] = None, heads: Optional[Dict[str, Tuple[Optional[int], bool]]] = None, auth: Optional[aiohttp.BasicAuth] = None) -> Optional[bool]:
+    """
+    Downloads data for a given patient from PhysioNet over the shared HTTP session.
+
+    Transient failures are retried with exponential backoff. The folder is always listed
+    on PhysioNet, while the file downloads move on to the next mirror on every attempt. Files are saved under the PhysioNet layout whichever
+    mirror served them, then checked against SHA256SUMS.txt; corrupt files are
+    deleted and fetched again on the next attempt.
+
+    Args:
+        session: The shared HTTP session.
+        patient_id: The ID of the patient to download data for.
+        download_directory: The directory where the downloaded data should be saved.
+        semaphore: Bounds the number of requests in flight across all patients.
+        file_urls: The files of the patient below URL_BASE when already listed, e.g. by --prefetch_sizes.
+        mirrors: The base URLs serving the MIMIC-CXR-JPG tree, starting with URL_BASE. Only URL_BASE when None.
+        checksums: The expected file digests from fetch_checksums, None or empty to skip verification.
+        heads: The result of head_file for each of file_urls when already known, e.g. from --prefetch_sizes.
+        auth: The PhysioNet credentials, only sent to PhysioNet.
+
+    Returns:
+        Whether the patient was downloaded and verified, None if it has no images to download.
+    """
+
+    mirrors = mirrors or [URL_BASE]
+
+    async def download_from(base: str) -> bool:
+        nonlocal file_urls
+        if file_urls is None:
+            try:
+                async with semaphore:
+                    file_urls = await list_patient_files(session, patient_id, auth)
+            except aiohttp.ClientResponseError as e:
+                if is_missing(e):
+                    return False
+                raise
+
+        async def bounded_download(file_url: str) -> None:
+            async with semaphore:
+                await download_file(session, rebase(file_url, URL_BASE, base), local_path(file_url, download_directory), (heads or {}).get(file_url), auth)
+
+        # Let every file finish before retrying, so two attempts never write the same file
+        results = await asyncio.gather(*(bounded_download(file_url) for file_url in file_urls), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+        if checksums:
+            await asyncio.get_running_loop().run_in_executor(None, verify_files, file_urls, download_directory, checksums)
+        return True
+
+    try:
+        log.info("patient %s: %s", patient_id, patient_url(patient_id))
+
+        async for attempt in retrying():
+            with attempt:
+                found = await download_from(mirrors[(attempt.retry_state.attempt_number - 1) % len(mirrors)])
+
+        if not found:
+            log.info("patient %s has no images", patient_id)
+            return None
+        mark_complete(patient_id, download_directory)
+        return True
+
+    except Exception as e:
+        log.error("An error occurred while downloading for patient %s: %s", patient_id, e)
+        return False
+
+async def produce_patient_ids(mimic_iv_csv_path: Path, download_directory: Path, patients: asyncio.Queue, workers: int, verified: Optional[Set[int]] = None) -> None:
+    """
+    Streams the pending patient IDs into a queue while the CSV is still being parsed.
+
+    Downloads start as soon as the first block is read instead of after the whole file.
+    Once the CSV is exhausted, one None per worker is queued to tell the workers to stop.
+
+    Args:
+        mimic_iv_csv_path: The path to the CSV file containing the patient IDs.
+        download_directory: The directory where the downloaded data should be saved.
+        patients: The bounded queue consumed by the download workers.
+        workers: The number of download workers.
+        verified: The patients verified by a previous run, see pending_patients.
+    """
+
+    loop = asyncio.get_running_loop()
+    blocks = iter_patient_ids(mimic_iv_csv_path)
+    seen, queued = set(), 0
+
+    try:
+        while True:
+            # Parse the next block off the event loop so downloads keep running meanwhile
+            block = await loop.run_in_executor(None, next, blocks, None)
+            if block is None:
+                break
+            new = set(block) - seen
+            seen.update(new)
+            pending = pending_patients(new, download_directory, verified)
+            for patient_id in interleave_shards(pending):
+                await patients.put((patient_id, None))
+            queued += len(pending)
+
+        log.info("Queued %d patients (%d already complete)", queued, len(seen) - queued)
+
+    finally:
+        for _ in range(workers):
+            await patients.put(None)
+
+
+async def patient_size(session: aiohttp.ClientSession, patient_id: int, semaphore: asyncio.Semaphore, auth: Optional[aiohttp.BasicAuth] = None) -> Optional[Tuple[int, int, Optional[Dict[str, Tuple[Optional[int], bool]]]]]:
+    """
+    Lists a patient's files and adds up their sizes with HEAD requests.
+
+    Args:
+        session: The shared HTTP session.
+        patient_id: The ID of the patient.
+        semaphore: Bounds the number of sizing requests in flight.
+        auth: The PhysioNet credentials.
+
+    Returns:
+        The patient ID, the total size in bytes and the result of head_file for each file URL,
+        which download_file reuses instead of sending the HEAD requests again, or None if the
+        patient has no images. A patient that could not be sized is returned with size 0 and
+        no file URLs, so it is still downloaded.
+    """
+
+    async def bounded_head(file_url: str) -> Tuple[Optional[int], bool]:
+        async with semaphore:
+            return await head_file(session, file_url, auth)
+
+    try:
+        async with semaphore:
+            file_urls = await list_patient_files(session, patient_id, auth)
+        heads = dict(zip(file_urls, await asyncio.gather(*(bounded_head(file_url) for file_url in file_urls))))
+        return patient_id, sum(size or 0 for size, _ in heads.values()), heads
 
     except Exception as e:
-        print(f"An error occurred while downloading for patient {patient_id}: {e}")
+        if is_missing(e):
+            log.info("patient %s has no images", patient_id)
+            return None
+        log.warning("An error occurred while sizing patient %s, queueing it last: %s", patient_id, e)
+        return patient_id, 0, None
+
 
-async def download_all_data(mimic_iv_csv_path: Path, wget_path: Path, download_directory: Path, username: str, password: str, min_workers: int) -> None:
+async def produce_largest_first(session: aiohttp.ClientSession, mimic_iv_csv_path: Path, download_directory: Path, patients: asyncio.Queue, workers: int, verified: Optional[Set[int]] = None, auth: Optional[aiohttp.BasicAuth] = None, results: Optional[Dict[int, Optional[bool]]] = None) -> None:
+    """
+    Queues the pending patients in decreasing order of folder size.
+
+    Starting with the largest folders keeps a few big patients from straggling at the
+    end while the other workers sit idle. Every folder has to be listed and sized
+    first, so nothing is queued until the whole CSV has been read and measured.
+
+    Args:
+        session: The shared HTTP session.
+        mimic_iv_csv_path: The path to the CSV file containing the patient IDs.
+        download_directory: The directory where the downloaded data should be saved.
+        patients: The bounded queue consumed by the download workers.
+        workers: The number of download workers.
+        verified: The patients verified by a previous run, see pending_patients.
+        auth: The PhysioNet credentials.
+        results: Collects the patients found to have no images while sizing, as patient_worker would.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    try:
+        patient_ids = await loop.run_in_executor(None, read_patient_ids, mimic_iv_csv_path)
+        pending = list(pending_patients(patient_ids, download_directory, verified))
+
+        sizing = asyncio.Semaphore(SIZING_CONCURRENCY)
+        entries = await asyncio.gather(*(patient_size(session, patient_id, sizing, auth) for patient_id in pending))
+        sized = [entry for entry in entries if entry is not None]
+        if results is not None:
+            # Record the patients without images here, since they are never queued
+            results.update((patient_id, None) for patient_id, entry in zip(pending, entries) if entry is None)
+        sized.sort(key=lambda entry: entry[1], reverse=True)
+        log.info("Queued %d patients, %.1f GB, largest first (%d already complete)", len(sized), sum(entry[1] for entry in sized) / 1e9, len(patient_ids) - len(pending))
+
+        for patient_id, _, heads in sized:
+            await patients.put((patient_id, heads))
+
+    finally:
+        for _ in range(workers):
+            await patients.put(None)
+
+
+async def patient_worker(session: aiohttp.ClientSession, patients: asyncio.Queue, download_directory: Path, semaphore: asyncio.Semaphore, mirrors: List[str], checksums: Dict[str, str], results: Dict[int, Optional[bool]], auth: Optional[aiohttp.BasicAuth]) -> None:
+    """
+    Downloads patients taken from the queue until it yields None.
+
+    Args:
+        session: The shared HTTP session.
+        patients: The queue of (patient ID, head_file results by file URL or None) filled by produce_patient_ids or produce_largest_first.
+        download_directory: The directory where the downloaded data should be saved.
+        semaphore: Bounds the number of requests in flight across all patients.
+        mirrors: The base URLs serving the MIMIC-CXR-JPG tree, starting with URL_BASE.
+        checksums: The expected file digests from fetch_checksums, empty to skip verification.
+        results: Collects whether each patient was downloaded and verified, None if it has no images.
+        auth: The PhysioNet credentials.
+    """
+
+    while True:
+        item = await patients.get()
+        if item is None:
+            return
+        patient_id, heads = item
+        file_urls = None if heads is None else list(heads)
+        results[patient_id] = await fetch_patient(session, patient_id, download_directory, semaphore, file_urls, mirrors, checksums, heads, auth)
+
+
+async def download_patient_batch(command: List[str], patient_ids: List[int], download_directory: Path, session: aiohttp.ClientSession, mirrors: Optional[List[str]] = None, checksums: Optional[Dict[str, str]] = None, auth: Optional[aiohttp.BasicAuth] = None) -> Dict[int, Optional[bool]]:
+    """
+    Downloads data for a batch of patients from PhysioNet with one long-lived downloader process.
+
+    The URLs are fed to the downloader on its standard input, so process creation,
+    the TLS handshake and authentication happen once per batch instead of once per patient.
+    Transient failures rerun the downloader with exponential backoff. aria2c moves on to
+    the next mirror on every attempt; wget and wget2 name their output after the host,
+    so they always retry against PhysioNet to keep the local layout. Files that do not
+    match SHA256SUMS.txt are deleted and count as a transient failure, so the rerun
+    fetches them again.
+
+    Args:
+        command: The downloader command, reading its URLs from standard input.
+        patient_ids: The IDs of the patients to download data for.
+        download_directory: The directory where the downloaded data should be saved.
+        session: The HTTP session used to list the patient folders.
+        mirrors: The base URLs serving the MIMIC-CXR-JPG tree, starting with URL_BASE. Only URL_BASE when None.
+        checksums: The expected file digests from fetch_checksums, None or empty to skip verification.
+        auth: The PhysioNet credentials, handed to aria2c for the PhysioNet URLs only.
+
+    Returns:
+        Whether each patient was downloaded and verified, None if it has no images.
+    """
+
+    mirrors = mirrors or [URL_BASE]
+
+    try:
+        # List the folders here so the downloader only issues GETs for the files themselves
+        outcomes, file_urls, corrupt, unverifiable = {}, {}, [], []
+        listing = asyncio.Semaphore(SIZING_CONCURRENCY)
+
+        async def list_patient(patient_id: int) -> None:
+            try:
+                async for attempt in retrying():
+                    with attempt:
+                        async with listing:
+                            file_urls[patient_id] = await list_patient_files(session, patient_id, auth)
+            except Exception as e:
+                if is_missing(e):
+                    log.info("patient %s has no images", patient_id)
+                    outcomes[patient_id] = None
+                else:
+                    log.error("An error occurred while listing files for patient %s: %s", patient_id, e)
+                    outcomes[patient_id] = False
+
+        await asyncio.gather(*(list_patient(patient_id) for patient_id in patient_ids))
+        listed = [patient_id for patient_id in patient_ids if patient_id in file_urls]
+        log.info("batch of %d patients starting with %s: %s", len(patient_ids), patient_ids[0], command[0])
+
+        def verify() -> None:
+            corrupt.clear()
+            unverifiable.clear()
+            for patient_id in listed:
+                try:
+                    verify_files(file_urls[patient_id], download_directory, checksums)
+                except MissingChecksums as e:
+                    # Rerunning the downloader would not change SHA256SUMS.txt
+                    log.error("patient %s: %s", patient_id, e)
+                    unverifiable.append(patient_id)
+                except ChecksumMismatch as e:
+                    log.warning("patient %s: %s", patient_id, e)
+                    corrupt.append(patient_id)
+            if corrupt:
+                raise ChecksumMismatch(f"{len(corrupt)} patients failed verification")
+
+        try:
+            async for attempt in retrying():
+                with attempt:
+                    batch_urls = [file_url for patient_id in listed for file_url in file_urls[patient_id]]
+                    if not Path(command[0]).name.startswith("aria2c"):
+                        lines = batch_urls
+                    else:
+                        # aria2c is told where each file goes, so it can fetch them from any mirror
+                        base = mirrors[(attempt.retry_state.attempt_number - 1) % len(mirrors)]
+                        lines = [f"{rebase(file_url, URL_BASE, base)}\n  out={local_path(file_url, Path())}" for file_url in batch_urls]
+                        credentials = request_auth(base, auth)
+                        if credentials is not None:
+                            lines = [f"{line}\n  http-user={credentials.login}\n  http-passwd={credentials.password}" for line in lines]
+                    urls = "".join(line + "\n" for line in lines)
+
+                    # Run the downloader without tying up a thread while it runs; its progress output
+                    # would only contend for the terminal with the other workers, so discard it
+                    process = await asyncio.create_subprocess_exec(*command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    await process.communicate(urls.encode())
+                    if process.returncode != 0:
+                        raise subprocess.CalledProcessError(process.returncode, command)
+
+                    if checksums:
+                        await asyncio.get_running_loop().run_in_executor(None, verify)
+
+        except ChecksumMismatch as e:
+            # Keep the patients that did verify; only the corrupt ones are reported
+            log.error("A batch of %d patients starting with %s could not be verified: %s", len(patient_ids), patient_ids[0], e)
+
+        for patient_id in listed:
+            if patient_id in corrupt or patient_id in unverifiable:
+                outcomes[patient_id] = False
+            else:
+                mark_complete(patient_id, download_directory)
+                outcomes[patient_id] = True
+        return outcomes
+
+    except Exception as e:
+        log.error("An error occurred while downloading for a batch of %d patients starting with %s: %s", len(patient_ids), patient_ids[0], e)
+        return {patient_id: False for patient_id in patient_ids}
+
+async def download_all_data(mimic_iv_csv_path: Path, wget_path: Path, download_directory: Path, username: str, password: str, min_workers: Optional[int], backend: str = "aiohttp", bandwidth: Optional[float] = None, rtt: Optional[float] = None, prefetch_sizes: bool = False, mirrors: Optional[List[str]] = None) -> Optional[List[int]]:
     """
     Downloads data for all patients in the given CSV file.
 
     Args:
         mimic_iv_csv_path: The path to the CSV file containing the patient IDs.
-        wget_path: The path to the wget executable.
+        wget_path: The path to wget, wget2 or aria2c for the wget backend. Found on the PATH when None.
         download_directory: The directory where the downloaded data should be saved.
         username: The PhysioNet username.
         password: The PhysioNet password.
-        min_workers: The minimum number of workers to use. The actual number of workers will be the minimum of this value and the number of patients.
+        min_workers: The number of patients downloaded concurrently, or the number of wget processes. Sized from bandwidth and rtt when None.
+        backend: "aiohttp" to download in-process over a shared connection pool, or "wget" to split the patients across min_workers external downloader processes.
+        bandwidth: The available bandwidth in Mbit/s, used to size the workers. DEFAULT_BANDWIDTH when None.
+        rtt: The round-trip time to PhysioNet in seconds, used to size the workers. Measured when None.
+        prefetch_sizes: Whether the aiohttp backend sizes every patient folder first and downloads the largest ones first.
+        mirrors: Base URLs of mirrors of URL_BASE, tried in turn after PhysioNet when a download is retried.
 
     Returns:
-        None
+        The IDs of the patients that could not be downloaded, or None if the download could not run at all.
     """
 
     try:
-        # Step 1: Read the CSV file and extract subject_id column
-        df = pd.read_csv(mimic_iv_csv_path)
-        patient_ids = set(df['subject_id'].astype(str).tolist())  # Convert to string set
+        mirrors = [URL_BASE] + [mirror if mirror.endswith("/") else mirror + "/" for mirror in mirrors or []]
 
-        # Step 2: For each patient, construct the wget command and run it
-        with ThreadPoolExecutor(max_workers=min(min_workers, len(patient_ids))) as executor:
-            loop = asyncio.get_running_loop()
-            tasks = [loop.run_in_executor(executor, download_patient_data, patient_id, wget_path, download_directory, username, password) for patient_id in patient_ids if patient_id.isdigit()]
-            await asyncio.gather(*tasks)
+        if min_workers is None:
+            if rtt is None:
+                rtt = await measure_rtt(username, password)
+            min_workers = worker_count(bandwidth or DEFAULT_BANDWIDTH, rtt)
+            log.info("Using %d workers (round-trip time %.0f ms)", min_workers, rtt * 1000)
+
+        auth = aiohttp.BasicAuth(username, password)
+        async with open_session(min_workers) as session:
+            # Verify against PhysioNet's checksums when they are available; the manifest of a
+            # previous run then decides which patients are skipped
+            checksums = await fetch_checksums(session, download_directory, auth)
+            verified = read_verified(download_directory) if checksums else None
+            results = {}
+            saver = asyncio.create_task(save_manifest(results, download_directory)) if checksums else None
+
+            try:
+                if backend == "aiohttp":
+                    # Stream the patients out of the CSV straight to min_workers download workers
+                    log.info("Downloading data into %s", download_directory)
+                    patients = asyncio.Queue(maxsize=min_workers)
+
+                    requests = asyncio.Semaphore(min_workers)
+                    workers = [asyncio.create_task(patient_worker(session, patients, download_directory, requests, mirrors, checksums, results, auth)) for _ in range(min_workers)]
+                    if prefetch_sizes:
+                        await produce_largest_first(session, mimic_iv_csv_path, download_directory, patients, min_workers, verified, auth, results)
+                    else:
+                        await produce_patient_ids(mimic_iv_csv_path, download_directory, patients, min_workers, verified)
+                    await asyncio.gather(*workers)
+
+                else:
+                    # Step 1: Read the CSV file and extract subject_id column, skipping patients finished by a previous run
+                    patient_ids = read_patient_ids(mimic_iv_csv_path)
+                    pending = pending_patients(patient_ids, download_directory, verified)
+                    log.info("Downloading data for %d patients into %s (%d already complete)", len(pending), download_directory, len(patient_ids) - len(pending))
+                    patient_ids = interleave_shards(pending)
+
+                    # Step 2: Split the patients across the downloader processes
+                    executable = find_downloader(wget_path)
+                    command = downloader_command(executable, download_directory, username, password)
+
+                    # Split the patients into contiguous batches, one per downloader process; each batch
+                    # cycles through the shards, whereas dealing round-robin could pin a worker to one shard
+                    size = max(1, -(-len(patient_ids) // min_workers))
+                    batches = [patient_ids[start:start + size] for start in range(0, len(patient_ids), size)]
+
+                    async def run_batch(batch: List[int]) -> None:
+                        # Record each batch as soon as it is done, for the periodic saves of the manifest
+                        results.update(await download_patient_batch(command, batch, download_directory, session, mirrors, checksums, auth))
+
+                    await asyncio.gather(*(run_batch(batch) for batch in batches))
+
+            finally:
+                # Save what was verified even when the run is interrupted, so the next run skips it
+                if saver is not None:
+                    saver.cancel()
+                    write_manifest(results, download_directory)
+
+        failed = [patient_id for patient_id, ok in results.items() if ok is False]
+
+        if failed:
+            log.error("Could not download %d patients: %s", len(failed), " ".join(str(patient_id) for patient_id in sorted(failed)))
+        return failed
 
     except Exception as e:
-        print(f"An error occurred: {e}")
+        log.error("An error occurred: %s", e)
+        return None
 
 if __name__ == "__main__":
 
     # Define the command-line arguments
     parser = argparse.ArgumentParser(description="Download data for MIMIC-IV patients")
     parser.add_argument("--mimic_iv_csv_path", type=Path, required=True, help="Path to the CSV file")
-    parser.add_argument("--wget_path", type=Path, required=True, help="Path to the wget executable")
+    parser.add_argument("--wget_path", type=Path, help="Path to wget, wget2 or aria2c for the wget backend (default: first of wget2, aria2c, wget on the PATH)")
     parser.add_argument("--download_directory", type=Path, required=True, help="Path to local download directory")
     parser.add_argument("--username", type=str, required=True, help="PhysioNet username")
     parser.add_argument("--password", type=str, required=True, help="PhysioNet password")
-    parser.add_argument("--min_workers", type=int, default=20, help="Minimum number of concurrent tasks")
+    parser.add_argument("--min_workers", type=int, default=None, help="Number of concurrent tasks (default: sized from the bandwidth-delay product)")
+    parser.add_argument("--bandwidth", type=float, default=None, help=f"Available bandwidth in Mbit/s used to size the workers (default: {DEFAULT_BANDWIDTH:g})")
+    parser.add_argument("--prefetch_sizes", action="store_true", help="Size every patient folder first and download the largest ones first (aiohttp backend only)")
+    parser.add_argument("--mirror", type=str, action="append", default=[], help=f"Base URL of a mirror of {URL_BASE} to rotate to on retries (repeatable)")
+    parser.add_argument("--rtt", type=float, default=None, help="Round-trip time to PhysioNet in ms used to size the workers (default: measured)")
+    parser.add_argument("--backend", type=str, default="aiohttp", choices=["aiohttp", "wget"], help="Download in-process with aiohttp or with a pool of wget2/aria2c/wget processes")
 
     # Parse the command-line arguments
     args = parser.parse_args()
 
+    # Run on uvloop where it is installed, which schedules thousands of in-flight requests
+    # far faster than the default event loop
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+
     # Call the function to download data
-    asyncio.run(download_all_data(args.mimic_iv_csv_path, args.wget_path, args.download_directory, args.username, args.password, args.min_workers))
\ No newline at end of file
+    listener = start_logging()
+    try:
+        main = download_all_data(args.mimic_iv_csv_path, args.wget_path, args.download_directory, args.username, args.password, args.min_workers, args.backend, args.bandwidth, args.rtt / 1000 if args.rtt is not None else None, args.prefetch_sizes, args.mirror)
+        if uvloop is None:
+            failed = asyncio.run(main)
+        elif sys.version_info >= (3, 12):
+            with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+                failed = runner.run(main)
+        else:
+            uvloop.install()
+            failed = asyncio.run(main)
+    finally:
+        listener.stop()
+
+    # Make missing patients visible to whatever runs this script
+    if failed is None or failed:
+        sys.exit(1)